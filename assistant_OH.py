@@ -30,11 +30,23 @@ It is available for Raspberry Pi 2/3 only; Pi Zero is not supported.
 Modified from Google AIY demo scripts by David Vargas (https://github.com/dvcarrillo)
 """
 
+import asyncio
+import atexit
 import logging
+import os
+import re
 import subprocess
 import threading
-import requests
+import time
 import sys
+from concurrent.futures import ThreadPoolExecutor
+
+import aiohttp
+
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
 
 import aiy.assistant.auth_helpers
 import aiy.assistant.device_helpers
@@ -49,19 +61,23 @@ openhab_ip = "localhost"
 openhab_port = "8080"
 
 # Set the group containing all the lights
+# (None to send "all the lights" commands to each of the light_colors Items instead)
 all_lights_group = 'Lights_ALL'
 
 # Set the Items on OpenHAB related to your light bulbs
 # The lights_ids array will be used for identifying each light in the spoken commands
 light_colors = ['hue_0210_00178828e0d0_1_color']
 light_color_temps = ['hue_0210_00178828e0d0_1_color_temperature']
-lights_ids = ['office']     # Example: "turn on the office light"
+lights_ids = ['office']     # One word each. Example: "turn on the office light"
 
 # Hotwords that triggers the OpenHAB actions
 custom_hotword = 'home'
 
-# Show debug information (0 = false, 1 = true)
-debug = 1
+# Seconds the state of a light is reused by consecutive commands before reading it again
+state_ttl = 0.5
+
+# Debug information (the requests sent to openHAB) is shown when the OH_DEBUG
+# environment variable is set
 # -----------------------
 
 # The en-GB voice is clearer than the default en-US
@@ -71,78 +87,272 @@ logging.basicConfig(
     level=logging.INFO,
     format="[%(asctime)s] %(levelname)s:%(name)s:%(message)s"
 )
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG if os.environ.get('OH_DEBUG') else logging.INFO)
+
+# -- Command vocabulary --
+# Built once at startup, the words of each command are looked up in these tables
+
+TURN_ACTIONS = {'turn', 'power', 'set', 'change'}
+REBOOT_ACTIONS = {'reboot', 'restart'}
+
+# Brightness percentage added for each action
+BRIGHTNESS_STEPS = {'increase': 25, 'raise': 25,
+                    'decrease': -25, 'reduce': -25}
+
+SWITCH_STATES = {'on': 'ON', 'off': 'OFF'}
+
+# Hue and saturation of each color (the brightness of the light is kept)
+COLOR_STATES = {'red': '0,100', 'yellow': '100,100', 'blue': '260,100',
+                'pink': '340,100', 'green': '140,100'}
+
+# Color temperature percentage of each white
+TEMP_STATES = {'cool': '0', 'warm': '100', 'natural': '50'}
+
+# Words of a command, leaving out the punctuation added by the speech recognition
+WORD_RE = re.compile(r"[\w']+")
+
+# Any of the words above that can follow a light, matched in a single pass
+LIGHT_STATE_RE = re.compile(r'\b(' + '|'.join(
+    list(SWITCH_STATES) + list(COLOR_STATES) + list(TEMP_STATES)) + r')\b')
+
+# Position of each light in the light arrays
+LIGHT_INDEX = {light_id: idx for idx, light_id in enumerate(lights_ids)}
+
+# -- Text to speech --
+
+# Answers are spoken from a single worker so they never block the caller and
+# are still played one after the other
+_tts_pool = ThreadPoolExecutor(max_workers=1)
+
+def say(message):
+    return _tts_pool.submit(aiy.audio.say, message)
 
 # -- OpenHAB 2 commands using OpenHAB REST API --
 
-def openhab_send(item, state):
-    url = 'http://' + openhab_ip + ':' + openhab_port + '/rest/items/' + item
-    headers = { 'content-type': 'text/plain',
-                'accept': 'application/json' }
-    r = requests.post(url, headers=headers, data=state)
-
-    if (debug):
-        print('REQUEST [POST]: ' + url + ' STATE: ' + state)
-
-    if r.status_code == 200:
-        aiy.audio.say('OK')
-    elif r.status_code == 400:
-        if (debug):
-            print('ERROR [HTTP 400]: ' + r.text)
-        aiy.audio.say('There has been an error: bad command')
-    elif r.status_code == 404:
-        if (debug):
-            print('ERROR [HTTP 404]: ' + r.text)
-        aiy.audio.say('There has been an error: unknown item')
+# REST URLs of the configured Items, built once
+ITEMS_URL = 'http://' + openhab_ip + ':' + openhab_port + '/rest/items/'
+ITEM_URLS = {item: ITEMS_URL + item
+             for item in light_colors + light_color_temps + [all_lights_group] if item}
+STATE_URLS = {item: url + '/state' for item, url in ITEM_URLS.items()}
+
+HEADERS = { 'content-type': 'text/plain',
+            'accept': 'application/json' }
+
+# The state of an Item is only served as plain text
+STATE_HEADERS = { 'accept': 'text/plain' }
+
+# The REST calls run as coroutines on an event loop living in its own thread,
+# sharing a single keep-alive HTTP session. Commands are queued to it and run
+# one after the other (all of them set up by start_openhab_loop)
+_loop = None
+_loop_thread = None
+_session = None
+_commands = None
+_worker = None
+
+# Last known state of each item and when it was read or sent, so that color and
+# brightness commands given within state_ttl only need a single request
+_state_cache = {}
+
+async def _open_session():
+    global _session, _commands, _worker
+    # All the requests go to the same server, so cap the connections opened to it
+    connector = aiohttp.TCPConnector(limit=8, limit_per_host=4, keepalive_timeout=60)
+    # Commands run one after the other, so a stalled request must not hold the
+    # following ones for long
+    timeout = aiohttp.ClientTimeout(total=3)
+    _session = aiohttp.ClientSession(connector=connector, headers=HEADERS, timeout=timeout)
+    _commands = asyncio.Queue()
+    _worker = _loop.create_task(_run_commands())
+
+async def _run_commands():
+    while True:
+        command = await _commands.get()
+        try:
+            await command
+        except Exception:
+            logger.exception('openHAB command failed')
+
+def start_openhab_loop():
+    global _loop, _loop_thread
+    # uvloop is a faster drop-in replacement for the default event loop
+    if uvloop is not None:
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    _loop = asyncio.new_event_loop()
+    _loop.run_until_complete(_open_session())
+    _loop_thread = threading.Thread(target=_loop.run_forever, daemon=True)
+    _loop_thread.start()
+    atexit.register(stop_openhab_loop)
+
+async def _close_session():
+    # Stop the worker, dropping the commands not run yet
+    _worker.cancel()
+    try:
+        await _worker
+    except asyncio.CancelledError:
+        pass
+    while not _commands.empty():
+        _commands.get_nowait().close()
+    await _session.close()
+
+def stop_openhab_loop():
+    # Close the pooled connections cleanly before exiting
+    submit(_close_session()).result()
+    _loop.call_soon_threadsafe(_loop.stop)
+    _loop_thread.join()
+    _loop.close()
+
+def submit(coro):
+    # Schedule a coroutine on the openHAB loop from any other thread
+    return asyncio.run_coroutine_threadsafe(coro, _loop)
+
+def queue_command(coro):
+    # Queue an openHAB command from any other thread, returning immediately
+    _loop.call_soon_threadsafe(_commands.put_nowait, coro)
+
+async def _post(item, state):
+    # Returns the HTTP status and body, or no status if openHAB is unreachable
+    url = ITEM_URLS.get(item) or ITEMS_URL + item
+    try:
+        async with _session.post(url, data=state) as r:
+            status = r.status
+            text = await r.text()
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        return None, str(e) or 'Timeout'
+
+    logger.debug('REQUEST [POST]: %s STATE: %s', url, state)
+
+    if status == 200:
+        # An HSB value is the new state of the item, anything else (ON, OFF...)
+        # leaves it unknown until it is read again
+        if state.count(',') == 2:
+            _state_cache[item] = (time.monotonic(), state)
+        else:
+            _state_cache.pop(item, None)
+    return status, text
+
+def _report(status, text):
+    if status == 200:
+        say('OK')
+    elif status is None:
+        logger.debug('ERROR [CONNECTION]: %s', text)
+        say('Command failed')
+    elif status == 400:
+        logger.debug('ERROR [HTTP 400]: %s', text)
+        say('There has been an error: bad command')
+    elif status == 404:
+        logger.debug('ERROR [HTTP 404]: %s', text)
+        say('There has been an error: unknown item')
     else:
-        aiy.audio.say('Command failed')
-
-def openhab_get_state(item):
-    url = 'http://' + openhab_ip + ':' + openhab_port + '/rest/items/' + item + '/state'
-    r = requests.get(url)
-    return r.text
+        say('Command failed')
+
+async def openhab_send(item, state):
+    _report(*await _post(item, state))
+
+async def openhab_send_many(items_states):
+    # Send all the (item, state) pairs concurrently and answer only once,
+    # reporting the first failure if there is any
+    results = await asyncio.gather(*[_post(item, state) for item, state in items_states])
+    _report(*next((result for result in results if result[0] != 200), (200, '')))
+
+def openhab_send_all_lights(state):
+    if all_lights_group:
+        return openhab_send(all_lights_group, state)
+    return openhab_send_many([(item, state) for item in light_colors])
+
+async def _fetch_state(item):
+    url = STATE_URLS.get(item) or ITEMS_URL + item + '/state'
+    async with _session.get(url, headers=STATE_HEADERS) as r:
+        r.raise_for_status()
+        state = await r.text()
+    _state_cache[item] = (time.monotonic(), state)
+    return state
+
+async def openhab_get_state(item):
+    timestamp, state = _state_cache.get(item, (0, None))
+    if state is not None and time.monotonic() - timestamp < state_ttl:
+        return state
+    return await _fetch_state(item)
+
+async def _get_hsb_state(item):
+    # Hue, saturation and brightness of the item, or None after answering if it
+    # cannot be read or is not a color (NULL or UNDEF for a bulb that is offline)
+    try:
+        current_state = (await openhab_get_state(item)).split(',')
+    except (aiohttp.ClientError, asyncio.TimeoutError):
+        current_state = None
+    if current_state is None or len(current_state) != 3:
+        say('Command failed')
+        return None
+    return current_state
+
+async def openhab_set_color(item, hue_sat):
+    # Keep the current brightness, only hue and saturation change
+    current_state = await _get_hsb_state(item)
+    if current_state is not None:
+        await openhab_send(item, ','.join((hue_sat, current_state[2])))
+
+async def openhab_change_brightness(item, step):
+    current_state = await _get_hsb_state(item)
+    if current_state is None:
+        return
+
+    hue, saturation, brightness = current_state
+    new_brightness = int(brightness) + step
+    if (new_brightness > 100):
+        new_brightness = 100
+    elif (new_brightness < 0):
+        new_brightness = 0
+
+    await openhab_send(item, ','.join((hue, saturation, str(new_brightness))))
 
 # -- Power management commands --
 
+# The commands are run by the TTS worker right after the goodbye has been heard,
+# so the assistant does not have to wait for it
+
+def _run_system_command(args):
+    try:
+        subprocess.Popen(args, close_fds=True)
+    except OSError:
+        logger.exception('Could not run %s', args[0])
+
 def power_off_pi():
-    aiy.audio.say('Powering off the system. Good bye!')
-    subprocess.call('sudo shutdown now', shell=True)
+    say('Powering off the system. Good bye!')
+    _tts_pool.submit(_run_system_command, ['/sbin/shutdown', '-h', 'now'])
 
 def reboot_pi():
-    aiy.audio.say('Rebooting the system. Hold on!')
-    subprocess.call('sudo reboot', shell=True)
+    say('Rebooting the system. Hold on!')
+    _tts_pool.submit(_run_system_command, ['/sbin/reboot'])
 
 def not_recognized():
-    aiy.audio.say('Sorry, I cannot do that yet')
+    say('Sorry, I cannot do that yet')
 
 def device_not_found():
-    aiy.audio.say('Sorry, I don\'t know that device')
+    say('Sorry, I don\'t know that device')
 
 def test_speech():
-    aiy.audio.say('Hello. This is a Text to Speech test.')
+    say('Hello. This is a Text to Speech test.')
 
 # -- Helper functions -- 
 
-def any_idx(iterable):
-    idx = 0
-    for element in iterable:
-        if element:
-            return idx
-        else:
-            idx = idx + 1
+def lookup(table, tokens):
+    # Value of the first word of the table said in the command, None otherwise
+    return next((table[word] for word in table if word in tokens), None)
 
 # -- Class MyAssistant --
 
 class MyAssistant(object):
     """
-    An assistant that runs in the background.
+    An assistant that runs in the main thread.
 
-    The Google Assistant Library event loop blocks the running thread entirely.
-    To support the button trigger, we need to run the event loop in a separate
-    thread. Otherwise, the on_button_pressed() method will never get a chance to
-    be invoked.
+    The Google Assistant Library event loop blocks the running thread entirely,
+    so the event handlers never wait for anything: openHAB commands are queued
+    to the openHAB event loop thread and the answers to the TTS worker. The
+    button trigger calls on_button_pressed() from its own thread.
     """
     def __init__(self):
-        self._task = threading.Thread(target=self._run_task)
         self._can_start_conversation = False
         self._assistant = None
 
@@ -150,11 +360,9 @@ class MyAssistant(object):
         """
         Starts the assistant.
 
-        Starts the assistant event loop and begin processing events.
+        Runs the assistant event loop and processes its events, blocking the
+        calling thread.
         """
-        self._task.start()
-
-    def _run_task(self):
         credentials = aiy.assistant.auth_helpers.get_assistant_credentials()
         model_id, device_id = aiy.assistant.device_helpers.get_ids(credentials)
         with Assistant(credentials, model_id) as assistant:
@@ -184,114 +392,70 @@ class MyAssistant(object):
             status_ui.status('thinking')
 
         elif event.type == EventType.ON_RECOGNIZING_SPEECH_FINISHED and event.args:
-            print('You said:', event.args['text'])
-            text = event.args['text'].lower()
+            raw_text = event.args['text']
+            print('You said:', raw_text)
 
             # CHECK HOTWORD
-            if text.startswith(custom_hotword):
+            # Only the beginning is lowercased, the whole text just for openHAB commands
+            if raw_text[:len(custom_hotword)].lower() == custom_hotword:
                 self._assistant.stop_conversation()
-                text = text + " "
+                text = raw_text.lower()
+                tokens = frozenset(WORD_RE.findall(text))
+                step = lookup(BRIGHTNESS_STEPS, tokens)
+                match = LIGHT_STATE_RE.search(text)
+                word = match.group(1) if match else None
 
                 # CHECK ACTION
                 # Power, turn, set, change
-                if any(token in text for token in (' turn ', ' power ', ' set ', ' change ')):
+                if TURN_ACTIONS & tokens:
                     # CHECK DEVICE
                     # For all the lights
-                    if ' all ' in text and ' lights ' in text:
-                        if ' on ' in text:
-                            openhab_send(all_lights_group, 'ON')
-                        elif ' off ' in text:
-                            openhab_send(all_lights_group, 'OFF')
+                    if 'all' in tokens and 'lights' in tokens:
+                        if word in SWITCH_STATES:
+                            queue_command(openhab_send_all_lights(SWITCH_STATES[word]))
                         else:
                             not_recognized()
 
                     # For a specific light
-                    elif ' light ' in text:
+                    elif 'light' in tokens:
                         # Get the index of the mentioned item in the light arrays
-                        idx = any_idx(token in text for token in lights_ids)
-                        if (idx != None):
+                        idx = lookup(LIGHT_INDEX, tokens)
+                        if idx is not None:
                             direct_to_color = light_colors[idx]
                             direct_to_color_temp = light_color_temps[idx]
-                            current_state = openhab_get_state(direct_to_color).split(',')
-
-                            if ' on ' in text:
-                                openhab_send(direct_to_color, 'ON')
-                            elif ' off ' in text:
-                                openhab_send(direct_to_color, 'OFF')
-                            elif ' red ' in text:
-                                new_state = "0,100," + current_state[2]
-                                openhab_send(direct_to_color, new_state)
-                            elif ' yellow ' in text:
-                                new_state = "100,100," + current_state[2]
-                                openhab_send(direct_to_color, new_state)
-                            elif ' blue ' in text:
-                                new_state = "260,100," + current_state[2]
-                                openhab_send(direct_to_color, new_state)
-                            elif ' pink ' in text:
-                                new_state = "340,100," + current_state[2]
-                                openhab_send(direct_to_color, new_state)
-                            elif ' green ' in text:
-                                new_state = "140,100," + current_state[2]
-                                openhab_send(direct_to_color, new_state)
-                            elif ' cool ' in text:
-                                openhab_send(direct_to_color_temp, "0")
-                            elif ' warm ' in text:
-                                openhab_send(direct_to_color_temp, "100")
-                            elif ' natural ' in text:
-                                openhab_send(direct_to_color_temp, "50")
+                            if word in SWITCH_STATES:
+                                queue_command(openhab_send(direct_to_color, SWITCH_STATES[word]))
+                            elif word in COLOR_STATES:
+                                queue_command(openhab_set_color(direct_to_color, COLOR_STATES[word]))
+                            elif word in TEMP_STATES:
+                                queue_command(openhab_send(direct_to_color_temp, TEMP_STATES[word]))
                             else:
                                 not_recognized()
                         else:
                             device_not_found()
 
                     # For the system
-                    elif ' system ' in text:
-                        if ' off ' in text:
+                    elif 'system' in tokens:
+                        if word == 'off':
                             power_off_pi()
                     else:
                         not_recognized()
 
-                # Increase, raise
-                elif any(token in text for token in (' increase ', ' raise ')):
-                    if ' brightness ' in text and 'light' in text:
-                        idx = any_idx(token in text for token in lights_ids)
-                        if (idx != None):
-                            direct_to_color = light_colors[idx]
-                            current_state = openhab_get_state(direct_to_color).split(',')
-
-                            new_brightness = int(current_state[2]) + 25
-                            if (new_brightness > 100):
-                                new_brightness = 100
-                            
-                            new_state = current_state[0] + ',' + current_state[1] + ',' + str(new_brightness)
-                            openhab_send(direct_to_color, new_state)
-                        else:
-                            device_not_found()
-                    else:
-                        not_recognized()
-
-                # Decrease, reduce
-                elif any(token in text for token in (' decrease ', ' reduce ')):
-                    if ' brightness ' in text and 'light' in text:
-                        idx = any_idx(token in text for token in lights_ids)
-                        if (idx != None):
+                # Increase, raise, decrease, reduce
+                elif step:
+                    if 'brightness' in tokens and ('light' in tokens or 'lights' in tokens):
+                        idx = lookup(LIGHT_INDEX, tokens)
+                        if idx is not None:
                             direct_to_color = light_colors[idx]
-                            current_state = openhab_get_state(direct_to_color).split(',')
-                           
-                            new_brightness = int(current_state[2]) - 25
-                            if (new_brightness < 0):
-                                new_brightness = 0
-                            
-                            new_state = current_state[0] + ',' + current_state[1] + ',' + str(new_brightness)
-                            openhab_send(direct_to_color, new_state)
+                            queue_command(openhab_change_brightness(direct_to_color, step))
                         else:
                             device_not_found()
                     else:
                         not_recognized()
 
                 # Reboot, restart
-                elif any(token in text for token in (' reboot ', ' restart ')):
-                    if ' system ' in text:
+                elif REBOOT_ACTIONS & tokens:
+                    if 'system' in tokens:
                         reboot_pi()
                 else:
                     not_recognized()
@@ -312,6 +476,7 @@ class MyAssistant(object):
             self._assistant.start_conversation()
 
 def main():
+    start_openhab_loop()
     MyAssistant().start()
 
 if __name__ == '__main__':